@@ -1,5 +1,16 @@
+import argparse
+import gzip
+import json
+import os
+import sys
 import pygame as pg
-from math import e, pi, sin, cos, asin, acos, log, isinf
+from math import e, pi, sin, cos, asin, acos, log, isinf, isfinite, fsum
+from itertools import repeat
+from time import perf_counter
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class OperatorSetting:
     ''' Class handling all operators (+,-...) and their priority '''
@@ -11,6 +22,334 @@ class OperatorSetting:
         self.function = function
 
 
+class EvaluationBudget:
+    ''' Class counting how many points higher-order functions may still evaluate
+        Counting points instead of measuring time gives the same result on every machine '''
+
+    def __init__(self, points: int):
+        self.points = points
+
+    def spend(self, points: int, name: str) -> None:
+        self.points -= points
+        assert self.points >= 0, f'{name} needs too many steps'
+
+
+class CompiledExpression:
+    ''' Class compiling a RPN into a single python function of all variables
+        Used by higher-order functions to evaluate their body over whole batches of points
+        With numpy installed a batch is a single call on arrays, otherwise one call per point '''
+
+    def __init__(self, RPN: list):
+        namespace = {'pow': pow, 'inf': float('inf'), 'nan': float('nan')}
+        namespace.update(Expression.FUNCTIONS)
+        self.free_variables = set()
+
+        source_stack = []
+        for n in RPN:
+            if isinstance(n, OperatorSetting):
+                assert len(source_stack) >= 2, 'invalid expression'
+                left, right = source_stack[-2], source_stack[-1]
+                source_stack.pop()
+                source_stack.pop()
+                if n.name == '^':
+                    source_stack.append(f'pow({left}, {right})')
+                else:
+                    source_stack.append(f'({left} {n.name} {right})')
+            elif isinstance(n, HigherOrderCall):
+                name = f'_call{len(namespace)}'
+                namespace[name] = n
+                self.free_variables |= n.free_variables
+                source_stack.append(f'{name}(budget, {", ".join(Expression.VARIABLES)})')
+            elif n in Expression.FUNCTIONS:
+                assert len(source_stack) >= 1, 'invalid expression'
+                source_stack[-1] = f'{n}({source_stack[-1]})'
+            elif n in Expression.VARIABLES:
+                self.free_variables.add(n)
+                source_stack.append(n)
+            else:
+                source_stack.append(repr(float(n)))
+
+        assert len(source_stack) == 1, 'invalid expression'
+        source = f'lambda budget, {", ".join(Expression.VARIABLES)}: {source_stack[0]}'
+        self.function = eval(source, namespace)
+
+        # Calls of higher-order functions only take single values
+        self.vector_function = None
+        if np is not None and not any(isinstance(n, HigherOrderCall) for n in RPN):
+            self.vector_function = eval(source, dict(namespace, **Expression.VECTOR_FUNCTIONS))
+
+    def __call__(self, budget: EvaluationBudget, *values) -> float:
+        return self.function(budget, *values)
+
+    def evaluate_batch(self, variable: str, points, values: tuple, budget: EvaluationBudget) -> list:
+        ''' Evaluates the function at every point, keeping the other variables fixed
+            Returns a numpy array when numpy is installed and a list otherwise '''
+        if self.vector_function is not None:
+            if isinstance(points, range):
+                points = np.arange(points.start, points.stop, dtype=float)
+            else:
+                points = np.asarray(points, dtype=float)
+            # Raise on domain errors like the math functions do
+            with np.errstate(all='raise'):
+                result = self.vector_function(budget, *[points if name == variable else value
+                                                          for name, value in zip(Expression.VARIABLES, values)])
+            return np.broadcast_to(np.asarray(result, dtype=float), points.shape)
+
+        if isinstance(points, range):
+            points = map(float, points)
+        columns = [points if name == variable else repeat(value)
+                   for name, value in zip(Expression.VARIABLES, values)]
+        return list(map(self.function, repeat(budget), *columns))
+
+    def sum_batch(self, variable: str, points, values: tuple, budget: EvaluationBudget) -> float:
+        ''' Sum of the function over all points '''
+        results = self.evaluate_batch(variable, points, values, budget)
+        if self.vector_function is not None:
+            return float(np.sum(results))
+        return fsum(results)
+
+    def evaluate_batch_safely(self, variable: str, points: list, values: tuple, budget: EvaluationBudget) -> list:
+        ''' Same as evaluate_batch, but points outside of the domain become nan '''
+        try:
+            return self.evaluate_batch(variable, points, values, budget)
+        except (ValueError, ArithmeticError, TypeError):
+            pass
+        result = []
+        for point in points:
+            try:
+                result.append(float(self.evaluate_batch(variable, [point], values, budget)[0]))
+            except (ValueError, ArithmeticError, TypeError):
+                result.append(float('nan'))
+        return result
+
+
+class HigherOrderSetting:
+    ''' Class handling all higher-order functions (int, sum...) and their arguments '''
+
+    def __init__(self, name: str, variable: (str | None), argument_count: int, function):
+        self.name = name
+        self.variable = variable
+        self.argument_count = argument_count
+        self.function = function
+
+
+class HigherOrderCall:
+    ''' Class handling a single call of a higher-order function inside the expression
+        The body and the arguments are compiled once when the RPN is created '''
+
+    def __init__(self, setting: HigherOrderSetting, variable: str,
+                 body: CompiledExpression, arguments: list):
+        self.setting = setting
+        self.variable = variable
+        self.body = body
+        self.arguments = arguments
+        self.free_variables = body.free_variables - {variable}
+        for argument in arguments:
+            self.free_variables |= argument.free_variables
+
+    def __call__(self, budget: EvaluationBudget, *values) -> float:
+        ''' Nested calls spend the budget of the outermost one '''
+        # math and numpy word the same domain errors differently, and complex results fail
+        # with a TypeError, so every one of them is reported the same way
+        try:
+            arguments = [float(argument(budget, *values)) for argument in self.arguments]
+            return self.setting.function(self.body, self.variable, values, arguments, budget)
+        except (ValueError, ArithmeticError, TypeError):
+            raise AssertionError(f'math error in {self.setting.name}') from None
+
+
+# Gauss-Kronrod 7-15 nodes and weights for the positive half of [-1, 1]
+KRONROD_NODES = [0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                 0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                 0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                 0.207784955007898467600689403773245, 0.0]
+KRONROD_WEIGHTS = [0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                   0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                   0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                   0.204432940075298892414161999234649, 0.209482141084727828012999174891714]
+GAUSS_WEIGHTS = [0.0, 0.129484966168869693270611432679082,
+                 0.0, 0.279705391489276667901467771423780,
+                 0.0, 0.381830050505118944950369775488975,
+                 0.0, 0.417959183673469387755102040816327]
+KRONROD_NODES = [-x for x in KRONROD_NODES[:-1]] + KRONROD_NODES[::-1]
+KRONROD_WEIGHTS = KRONROD_WEIGHTS[:-1] + KRONROD_WEIGHTS[::-1]
+GAUSS_WEIGHTS = GAUSS_WEIGHTS[:-1] + GAUSS_WEIGHTS[::-1]
+MAX_INTERVALS = 2 ** 14
+SUM_CHUNK_SIZE = 2 ** 16
+
+
+def integrate(body: CompiledExpression, variable: str, values: tuple,
+              arguments: list, budget: EvaluationBudget) -> float:
+    ''' Adaptive Gauss-Kronrod quadrature of the body from a to b
+        The worst intervals are split and evaluated in a single batch until the total error is small '''
+    a, b = arguments
+    assert isfinite(a) and isfinite(b), 'int bounds must be finite'
+    if a == b:
+        return 0.0
+    if a > b:
+        return -integrate(body, variable, values, [b, a], budget)
+
+    # Every interval is kept as [error, left, right, estimate]
+    intervals = []
+    new_intervals = [(a, b)]
+    while True:
+        points = [(left + right) / 2 + (right - left) / 2 * node
+                  for left, right in new_intervals for node in KRONROD_NODES]
+        budget.spend(len(points), 'int')
+        results = body.evaluate_batch(variable, points, values, budget)
+        for i, (left, right) in enumerate(new_intervals):
+            interval_results = results[i * 15:(i + 1) * 15]
+            kronrod = (right - left) / 2 * fsum(
+                w * f for w, f in zip(KRONROD_WEIGHTS, interval_results))
+            gauss = (right - left) / 2 * fsum(
+                w * f for w, f in zip(GAUSS_WEIGHTS, interval_results))
+            # numpy raises on an overflow where python quietly gives inf
+            assert isfinite(kronrod), 'math error in int'
+            intervals.append([abs(kronrod - gauss), left, right, kronrod])
+
+        # Stop once the errors of all intervals add up to less than the tolerance
+        error = fsum(interval[0] for interval in intervals)
+        tolerance = 1e-12 * max(1.0, abs(fsum(interval[3] for interval in intervals)))
+        if error <= tolerance:
+            return fsum(interval[3] for interval in intervals)
+        assert len(intervals) <= MAX_INTERVALS, 'int did not converge'
+
+        # Split the worst intervals covering half of the error in the next batch
+        intervals.sort(key=lambda interval: interval[0], reverse=True)
+        new_intervals = []
+        split_error = 0.0
+        i = 0
+        while i < len(intervals) and split_error < (error - tolerance) / 2:
+            interval_error, left, right, _ = intervals[i]
+            middle = (left + right) / 2
+            if left < middle < right:
+                new_intervals.append((left, middle))
+                new_intervals.append((middle, right))
+                split_error += interval_error
+                intervals.pop(i)
+            else:
+                i += 1
+        assert len(new_intervals) > 0, 'int did not converge'
+
+
+def summate(body: CompiledExpression, variable: str, values: tuple,
+            arguments: list, budget: EvaluationBudget) -> float:
+    ''' Sum of the body over all integers from first to last
+        Terms are evaluated and added up in chunks '''
+    first, last = arguments
+    assert first == int(first) and last == int(last), 'sum bounds must be integers'
+    assert int(last) - int(first) < budget.points, 'sum needs too many steps'
+
+    partial_sums = []
+    for start in range(int(first), int(last) + 1, SUM_CHUNK_SIZE):
+        end = min(start + SUM_CHUNK_SIZE, int(last) + 1)
+        budget.spend(end - start, 'sum')
+        partial_sums.append(body.sum_batch(variable, range(start, end), values, budget))
+        assert isfinite(partial_sums[-1]), 'math error in sum'
+    return fsum(partial_sums)
+
+
+def find_bracketed_root(body: CompiledExpression, variable: str, values: tuple,
+                        a: float, b: float, fa: float, fb: float, budget: EvaluationBudget) -> (float | None):
+    ''' Brent's method on a bracket with a sign change
+        Returns None when the sign change turns out to be a pole '''
+    bracket_scale = max(abs(fa), abs(fb))
+    if abs(fa) < abs(fb):
+        a, b, fa, fb = b, a, fb, fa
+    c, fc, d = a, fa, b - a
+    bisected = True
+    for _ in range(200):
+        if fb == 0 or abs(b - a) <= 1e-15 * max(1.0, abs(b)):
+            break
+        if fa != fc and fb != fc:
+            s = (a * fb * fc / ((fa - fb) * (fa - fc))
+                 + b * fa * fc / ((fb - fa) * (fb - fc))
+                 + c * fa * fb / ((fc - fa) * (fc - fb)))
+        else:
+            s = b - fb * (b - a) / (fb - fa)
+        if (not min((3 * a + b) / 4, b) < s < max((3 * a + b) / 4, b)
+                or (bisected and abs(s - b) >= abs(b - c) / 2)
+                or (not bisected and abs(s - b) >= abs(c - d) / 2)):
+            s = (a + b) / 2
+            bisected = True
+        else:
+            bisected = False
+        budget.spend(1, 'solve')
+        fs = body.evaluate_batch_safely(variable, [s], values, budget)[0]
+        if not isfinite(fs):
+            return None
+        c, fc, d = b, fb, c
+        if fa * fs < 0:
+            b, fb = s, fs
+        else:
+            a, fa = s, fs
+        if abs(fa) < abs(fb):
+            a, b, fa, fb = b, a, fb, fa
+
+    # A sign change across a pole shrinks the bracket just as well as a root
+    if abs(fb) > 1e-6 * bracket_scale:
+        return None
+    return b
+
+
+def find_root(body: CompiledExpression, variable: str, values: tuple,
+              arguments: list, budget: EvaluationBudget) -> float:
+    ''' Root of the body closest to x0
+        Candidates come from Newton's method and from Brent's method on the nearest sign changes
+        among points spreading out from x0, so a root between two of these points can be missed '''
+    x0 = arguments[0]
+    assert isfinite(x0), 'solve start must be finite'
+    roots = []
+
+    # Newton's method with a central difference derivative
+    x = x0
+    try:
+        for _ in range(100):
+            budget.spend(3, 'solve')
+            step = 1e-7 * max(1.0, abs(x))
+            left, middle, right = body.evaluate_batch(variable, [x - step, x, x + step], values, budget)
+            if middle == 0:
+                roots.append(x)
+                break
+            derivative = (right - left) / (2 * step)
+            if derivative == 0 or not isfinite(derivative):
+                break
+            new_x = x - middle / derivative
+            if not isfinite(new_x):
+                break
+            if abs(new_x - x) <= 1e-12 * max(1.0, abs(x)):
+                # A tiny step next to a jump is not a root
+                if abs(middle) <= 1e-3 * max(abs(left), abs(right)):
+                    roots.append(new_x)
+                break
+            x = new_x
+    except (ValueError, ArithmeticError, TypeError):
+        pass
+
+    # Newton's method can jump to a far away root, so look for nearer sign changes
+    distances = [1e-3 * 2 ** i for i in range(60)]
+    points = [x0 - d for d in reversed(distances)] + [x0] + [x0 + d for d in distances]
+    budget.spend(len(points), 'solve')
+    results = body.evaluate_batch_safely(variable, points, values, budget)
+    brackets = []
+    for i in range(len(points)):
+        if results[i] == 0:
+            roots.append(points[i])
+        elif i + 1 < len(points) and results[i] * results[i + 1] < 0:
+            brackets.append((min(abs(points[i] - x0), abs(points[i + 1] - x0)), i))
+    brackets.sort()
+    for distance, i in brackets:
+        if len(roots) > 0 and distance >= min(abs(root - x0) for root in roots):
+            break
+        root = find_bracketed_root(body, variable, values, points[i], points[i + 1],
+                                   results[i], results[i + 1], budget)
+        if root is not None:
+            roots.append(root)
+
+    assert len(roots) > 0, 'solve did not converge'
+    return min(roots, key=lambda root: abs(root - x0))
+
+
 class Expression:
     ''' Class handling the main expression
         Includes methods for solving and displaying it '''
@@ -28,7 +367,21 @@ class Expression:
         'sin': sin,
         'cos': cos,
         'ln': log}
+    HIGHER_ORDER_FUNCTIONS = {
+        'solve': HigherOrderSetting('solve', 'x', 2, find_root),
+        'sum': HigherOrderSetting('sum', None, 4, summate),
+        'int': HigherOrderSetting('int', 'x', 3, integrate)}
     CONSTANTS = {'eu': e, 'pi': pi}
+    VARIABLES = ('x', 'k')
+    VECTOR_FUNCTIONS = {} if np is None else {
+        'arccos': np.arccos,
+        'arcsin': np.arcsin,
+        'sin': np.sin,
+        'cos': np.cos,
+        'ln': np.log,
+        'pow': np.power}
+    EVALUATION_BUDGET = 5 * 10 ** 6
+    PREVIEW_EVALUATION_BUDGET = 2 * 10 ** 4
     MAX_STACK_LEN = 50
     fonts = []
 
@@ -39,7 +392,8 @@ class Expression:
             BORDER_COLOR: pg.Color, CURSOR_COLOR: pg.Color, 
             BORDER_WIDTH: int,
             font_path: str, font_size: int,
-            cursor_tick_time: int):
+            cursor_tick_time: int,
+            event_source: 'EventSource'):
 
         self.rect = pg.Rect(SPACE, top, WIDTH - SPACE * 2, height)
 
@@ -49,9 +403,11 @@ class Expression:
         self.CURSOR_COLOR = CURSOR_COLOR
         self.BORDER_WIDTH = BORDER_WIDTH
         self.SMALL_TEXT_COLOR = SMALL_TEXT_COLOR
+        self.event_source = event_source
 
         self.expression = []
         self.expression_stack = []
+        self.update_count = 0
         self.cursor_pointer = 0
 
         self.font_size = font_size
@@ -64,7 +420,7 @@ class Expression:
         self.precalculated_expression = None
         self.resize(height, top)
 
-        self.last_cursor_tick = pg.time.get_ticks()
+        self.last_cursor_tick = self.event_source.ticks()
         self.cursor_tick_time = cursor_tick_time
         self.draw_cursor = True
         self.error_tick = 0
@@ -103,6 +459,14 @@ class Expression:
         self.update()
 
 
+    def add_function(self, name: str) -> None:
+        ''' Add a function with its parentheses, leaving the cursor inside of them '''
+        self.add_to_stack()
+        self.expression[self.cursor_pointer:self.cursor_pointer] = [name, '(', ')']
+        self.cursor_pointer += 2
+        self.update()
+
+
     def delete_char(self, to_the_left: bool) -> None:
         ''' Delete sequence from the expression at the cursor pointer '''
         if to_the_left and self.cursor_pointer > 0:
@@ -116,12 +480,50 @@ class Expression:
             self.update()
 
 
-    def create_RPN(self) -> list:
+    def split_arguments(self, expression: list, i: int) -> tuple:
+        ''' Splits the parentheses starting at i into a list of arguments
+            Returns the arguments and the position right after the parentheses '''
+        if i >= len(expression) or expression[i] != '(':
+            raise AssertionError("parentheses after a function absent")
+        arguments = [[]]
+        depth = 0
+        i += 1
+        while i < len(expression):
+            if expression[i] == '(':
+                depth += 1
+            elif expression[i] == ')':
+                if depth == 0:
+                    return arguments, i + 1
+                depth -= 1
+            elif expression[i] == ',' and depth == 0:
+                arguments.append([])
+                i += 1
+                continue
+            arguments[-1].append(expression[i])
+            i += 1
+        raise AssertionError("parentheses out of order")
+
+
+    def create_call(self, setting: HigherOrderSetting, arguments: list) -> HigherOrderCall:
+        ''' Compiles the body and the arguments of a higher-order function '''
+        assert len(arguments) == setting.argument_count, \
+            f"{setting.name} needs {setting.argument_count} arguments"
+        variable = setting.variable
+        if variable is None:
+            assert (len(arguments[1]) == 1 
+                    and arguments[1][0] in self.VARIABLES), f"{setting.name} needs a variable"
+            variable = arguments.pop(1)[0]
+        body = CompiledExpression(self.create_RPN(arguments[0]))
+        return HigherOrderCall(setting, variable, body, 
+                               [CompiledExpression(self.create_RPN(a)) for a in arguments[1:]])
+
+
+    def create_RPN(self, expression: list = None) -> list:
         ''' Produces a RPN (Reverse Polish Notation) from the current expression 
             Algorithm used -> https://en.wikipedia.org/wiki/Shunting_yard_algorithm '''
         output = []
         operator_stack = []
-        expression = self.expression.copy()
+        expression = (self.expression if expression is None else expression).copy()
 
         if len(expression) > 0 and expression[0] == '-':
             output.append(0)
@@ -161,6 +563,17 @@ class Expression:
                 output.append(number)
                 continue
 
+            if expression[i] in self.HIGHER_ORDER_FUNCTIONS:
+                setting = self.HIGHER_ORDER_FUNCTIONS[expression[i]]
+                arguments, i = self.split_arguments(expression, i + 1)
+                output.append(self.create_call(setting, arguments))
+                continue
+
+            if expression[i] in self.VARIABLES:
+                output.append(expression[i])
+                i += 1
+                continue
+
             constant_placed = False
             for constant in self.CONSTANTS:
                 if expression[i] == constant:
@@ -228,7 +641,7 @@ class Expression:
         return output
 
 
-    def evaluate_RPN(self) -> float:
+    def evaluate_RPN(self, budget: EvaluationBudget) -> float:
         ''' Turns a RPN to a number '''
         RPN = self.create_RPN()
         
@@ -240,6 +653,11 @@ class Expression:
                 number_stack.pop()
                 number_stack.pop()
                 number_stack.append(n.function(left, right))
+            elif isinstance(n, HigherOrderCall):
+                assert len(n.free_variables) == 0, f'{min(n.free_variables)} is not bound'
+                number_stack.append(n(budget, *[None] * len(self.VARIABLES)))
+            elif n in self.VARIABLES:
+                raise AssertionError(f'{n} is not bound')
             elif n in self.FUNCTIONS:
                 assert len(number_stack) >= 1, 'invalid expression'
                 top = number_stack[-1]
@@ -251,13 +669,13 @@ class Expression:
         assert len(number_stack) == 1, 'invalid expression'
         return number_stack[0]
 
-    def evaluate_expression_result(self) -> (float | None):
+    def evaluate_expression_result(self, budget: int) -> (float | None):
         ''' Helper expression-evaluating function
             Used for desplaying pre-calculated result in the bottom '''
-        if self.prev_expression != None and pg.time.get_ticks() - self.error_tick <= self.error_time:
+        if self.prev_expression != None and self.event_source.ticks() - self.error_tick <= self.error_time:
             return None
         try:
-            number = round(float(self.evaluate_RPN()), 10)
+            number = round(float(self.evaluate_RPN(EvaluationBudget(budget))), 10)
             assert not isinf(number), 'number is too big'
 
         except Exception as e:
@@ -270,10 +688,10 @@ class Expression:
     def evaluate_expression(self) -> (float | None):
         ''' Main expression-evaluating function
             Handles errors and updates the main expression list '''
-        result = self.evaluate_expression_result()
+        result = self.evaluate_expression_result(self.EVALUATION_BUDGET)
         if isinstance(result, list):
             self.prev_expression = self.expression.copy()
-            self.error_tick = pg.time.get_ticks()
+            self.error_tick = self.event_source.ticks()
             self.expression = result
             self.cursor_pointer = len(self.expression)
             self.update()
@@ -289,7 +707,7 @@ class Expression:
     def update_cursor(self) -> None:
         ''' Updates cursors size and position '''
         self.draw_cursor = True
-        self.last_cursor_tick = pg.time.get_ticks()
+        self.last_cursor_tick = self.event_source.ticks()
         self.cursor_rect = pg.Rect(0, 0, 1, self.font_size)
         self.cursor_rect.centery = self.text_rect.centery - 4
         self.cursor_rect.right = self.text_rect.right - self.font.size(''.join(
@@ -298,6 +716,7 @@ class Expression:
 
     def update(self) -> None:
         ''' Updates size and position of main text '''
+        self.update_count += 1
         self.text_surf = self.font.render(''.join(
             [('e' if s == 'eu' else s) for s in self.expression]) + ' ', True, TEXT_COLOR)
         self.text_rect = self.text_surf.get_rect()
@@ -322,7 +741,8 @@ class Expression:
                 [('e' if s == 'eu' else s) for s in self.expression]) + ' ', True, TEXT_COLOR)
             self.text_rect = self.text_surf.get_rect()
 
-        calc = self.evaluate_expression_result()
+        # Keep typing responsive, the full budget is only given to '='
+        calc = self.evaluate_expression_result(self.PREVIEW_EVALUATION_BUDGET)
         if calc != None:
             calc = None if isinstance(calc, list) else list(str(calc))
         self.precalculated_expression = calc
@@ -341,7 +761,7 @@ class Expression:
 
     def draw(self) -> None:
         ''' Draws the expression onto the window'''
-        current_time = pg.time.get_ticks()
+        current_time = self.event_source.ticks()
 
         # Update error message
         if self.prev_expression is not None and current_time - \
@@ -427,12 +847,10 @@ class Button:
         elif self.name == 'e':
             self.expression.add_char('eu')
         else:
-            self.expression.add_char(self.name)
             if self.name in self.expression.FUNCTIONS:
-                self.expression.add_char('(')
-                self.expression.add_char(')')
-                self.expression.cursor_pointer -= 1
-                self.expression.update_cursor()
+                self.expression.add_function(self.name)
+            else:
+                self.expression.add_char(self.name)
 
         pressed_button = None
 
@@ -463,11 +881,140 @@ class Button:
         screen.blit(self.text_surf, self.text_rect)
 
 
+class EventSource:
+    ''' Class providing the events and the input state of every frame '''
+
+    def tick(self, clock: pg.Clock) -> None:
+        clock.tick(60)
+
+    def ticks(self) -> int:
+        ''' Returns the milliseconds since the start, used instead of pg.time.get_ticks() '''
+        return pg.time.get_ticks()
+
+    def get(self) -> tuple:
+        ''' Returns the events, mouse state, mouse position and shift state of the frame '''
+        return (pg.event.get(),
+                pg.mouse.get_pressed()[0],
+                pg.mouse.get_pos(),
+                pg.key.get_pressed()[pg.K_LSHIFT])
+
+    def close(self, expression: Expression) -> bool:
+        return True
+
+
+class EventRecorder(EventSource):
+    ''' Class recording every frame of the session into a gzipped json lines file
+        The first line holds the starting ticks and the last one the final expression '''
+
+    RECORDED_EVENTS = {pg.QUIT: (),
+                       pg.KEYDOWN: ('key', 'mod', 'unicode'),
+                       pg.MOUSEBUTTONDOWN: ('button', 'pos'),
+                       pg.MOUSEBUTTONUP: ('button', 'pos'),
+                       pg.VIDEORESIZE: ('w', 'h', 'size')}
+
+    def __init__(self, path: str):
+        self.file = gzip.open(path, 'wt')
+        self.file.write(json.dumps({'ticks': self.ticks()}) + '\n')
+
+    def get(self) -> tuple:
+        events, mouse_pressed, mouse_pos, is_shift_pressed = super().get()
+        recorded_events = [[event.type, {name: getattr(event, name)
+                                         for name in self.RECORDED_EVENTS[event.type]}]
+                           for event in events if event.type in self.RECORDED_EVENTS]
+        self.file.write(json.dumps(
+            [self.ticks(), mouse_pressed, mouse_pos, is_shift_pressed, recorded_events],
+            separators=(',', ':')) + '\n')
+        return events, mouse_pressed, mouse_pos, is_shift_pressed
+
+    def close(self, expression: Expression) -> bool:
+        self.file.write(json.dumps({'expression': expression.expression}) + '\n')
+        self.file.close()
+        return True
+
+
+class EventReplayer(EventSource):
+    ''' Class replaying a recorded session as fast as possible
+        Ticks are taken from the recording, so the replay is deterministic '''
+
+    def __init__(self, path: str, max_p95: (float | None), max_frame: (float | None)):
+        self.max_p95 = max_p95
+        self.max_frame = max_frame
+        lines = []
+        try:
+            with gzip.open(path, 'rt') as file:
+                for line in file:
+                    lines.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            pass
+        except (OSError, UnicodeDecodeError):
+            sys.exit(f'{path} is not a recorded session')
+        if len(lines) < 2 or not isinstance(lines[0], dict) or 'ticks' not in lines[0]:
+            sys.exit(f'{path} is not a recorded session')
+        if not isinstance(lines[-1], dict) or 'expression' not in lines[-1]:
+            sys.exit(f'{path} is incomplete, the recorded session did not end normally')
+        self.frames = lines[1:-1]
+        self.expected_expression = lines[-1]['expression']
+        self.frame = 0
+        self.frame_ticks = lines[0]['ticks']
+        self.frame_start = None
+        self.frame_times = []
+
+    def ticks(self) -> int:
+        return self.frame_ticks
+
+    def tick(self, clock: pg.Clock) -> None:
+        now = perf_counter()
+        if self.frame_start is not None:
+            self.frame_times.append(now - self.frame_start)
+        self.frame_start = now
+
+    def get(self) -> tuple:
+        if self.frame >= len(self.frames):
+            return [pg.event.Event(pg.QUIT)], False, (0, 0), False
+        self.frame_ticks, mouse_pressed, mouse_pos, is_shift_pressed, recorded_events = self.frames[self.frame]
+        self.frame += 1
+
+        events = []
+        for event_type, attributes in recorded_events:
+            attributes = {name: (tuple(value) if isinstance(value, list) else value)
+                          for name, value in attributes.items()}
+            # The main loop reads the new size from the window, not from the event
+            if event_type == pg.VIDEORESIZE:
+                pg.display.set_mode(attributes['size'], pg.RESIZABLE)
+            events.append(pg.event.Event(event_type, attributes))
+        return events, mouse_pressed, tuple(mouse_pos), is_shift_pressed
+
+    def close(self, expression: Expression) -> bool:
+        self.tick(None)
+        frame_times = sorted(self.frame_times) or [0.0]
+        percentile = lambda p: frame_times[round(p * (len(frame_times) - 1))] * 1000
+        matches = expression.expression == self.expected_expression
+        passed = matches
+
+        print(f'frames: {len(frame_times)}')
+        print(f'frame time (ms): mean {sum(frame_times) / len(frame_times) * 1000:.2f}, '
+              f'p50 {percentile(0.5):.2f}, p95 {percentile(0.95):.2f}, '
+              f'p99 {percentile(0.99):.2f}, max {percentile(1):.2f}')
+        print(f'update() calls: {expression.update_count}')
+        print(f'create_buttons() calls: {create_buttons_count}')
+        print(f'expression: {"".join(expression.expression)!r} '
+              f'(expected {"".join(self.expected_expression)!r}) {"OK" if matches else "MISMATCH"}')
+        for name, value, limit in [('p95', percentile(0.95), self.max_p95),
+                                   ('max', percentile(1), self.max_frame)]:
+            if limit is not None and value > limit:
+                print(f'frame time {name} {value:.2f} ms is over the limit of {limit:.2f} ms')
+                passed = False
+        return passed
+
+
 buttons = []
+create_buttons_count = 0
 
 
 def create_buttons():
     ''' Create buttons on creation/resize of the window '''
+    global create_buttons_count
+    create_buttons_count += 1
     buttons.clear()
     expression.resize(NUMBER_BUTTON_SIZE[1] * 3.1 // 2, SPACE)
     for i in range(1, 10):
@@ -550,8 +1097,28 @@ def create_buttons():
 
 
 
+parser = argparse.ArgumentParser(description='Simple expression calculator using Pygame')
+parser.add_argument('--record', metavar='FILE',
+                    help='record the input of the session into FILE')
+parser.add_argument('--replay', metavar='FILE',
+                    help='replay a recorded session without a display and report frame times')
+parser.add_argument('--max-p95', metavar='MS', type=float,
+                    help='fail the replay if the 95th percentile frame time is over MS')
+parser.add_argument('--max-frame', metavar='MS', type=float,
+                    help='fail the replay if any frame takes longer than MS')
+args = parser.parse_args()
+if args.replay is not None:
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+
 pg.init()
 
+if args.replay is not None:
+    event_source = EventReplayer(args.replay, args.max_p95, args.max_frame)
+elif args.record is not None:
+    event_source = EventRecorder(args.record)
+else:
+    event_source = EventSource()
+
 WIDTH = 600
 HEIGHT = 700
 MIN_WIDTH = 200
@@ -584,7 +1151,8 @@ expression = Expression(
     2,
     FONT_PATH,
     50,
-    600)
+    600,
+    event_source)
 create_buttons()
 
 screen = pg.display.set_mode((WIDTH, HEIGHT), pg.RESIZABLE)
@@ -630,66 +1198,80 @@ name_to_button['pi'] = [b for b in buttons if b.name == 'pi'][0]
 current_string = ''
 pg.key.set_repeat(500, 30)
 
-while app_running:
-    clock.tick(60)
-    screen.fill(BACKGROUND_COLOR)
-
-    mouse_pressed = pg.mouse.get_pressed()[0]
-    mouse_pressed_this_frame, mouse_released_this_frame = False, False
-    mouse_pos = pg.mouse.get_pos()
-    is_shift_pressed = pg.key.get_pressed()[pg.K_LSHIFT]
-
-    if not mouse_pressed:
-        pressed_button = None
-
-    for event in pg.event.get():
-        if event.type == pg.QUIT:
-            app_running = False
-
-        elif event.type == pg.MOUSEBUTTONDOWN:
-            if event.button == 1:
-                mouse_pressed_this_frame = True
-        elif event.type == pg.MOUSEBUTTONUP:
-            if event.button == 1:
-                mouse_released_this_frame = True
-        elif event.type == pg.KEYDOWN:
-            if is_shift_pressed:
-                if event.key in shift_key_to_button:
-                    shift_key_to_button[event.key].press()
-            else:
-                if event.key in key_to_button:
-                    key_to_button[event.key].press()
-                elif event.key == pg.K_DELETE:
-                    expression.delete_char(False)
-                elif event.key == pg.K_z:
-                    [b for b in buttons if b.name == 'undo'][0].press()
-            current_string += event.unicode
-            for name in name_to_button:
-                if current_string.endswith(name):
-                    name_to_button[name].press()
-                    current_string = ''
-        elif event.type == pg.VIDEORESIZE:
-            WIDTH, HEIGHT = screen.get_size()
-            recreate_window = WIDTH < MIN_WIDTH or HEIGHT < MIN_HEIGHT
-            if WIDTH < MIN_WIDTH:
-                WIDTH = MIN_WIDTH
-            if HEIGHT < MIN_HEIGHT:
-                HEIGHT = MIN_HEIGHT
-            if recreate_window:
-                screen = pg.display.set_mode((WIDTH, HEIGHT), pg.RESIZABLE)
-            NUMBER_BUTTON_SIZE = (
-                (WIDTH - SPACE * 6) // 5,
-                (HEIGHT - SPACE * 8) // 7)
-            BUTTON_SIZE = (
-                (WIDTH - SPACE * 6) // 5,
-                (NUMBER_BUTTON_SIZE[1] * 3 - SPACE) // 4)
-            create_buttons()
-
-    expression.draw()
-    for b in buttons:
-        b.update(mouse_pos, mouse_pressed,
-                 mouse_pressed_this_frame,
-                 mouse_released_this_frame)
-        b.draw()
-
-    pg.display.flip()
+try:
+    while app_running:
+        event_source.tick(clock)
+        screen.fill(BACKGROUND_COLOR)
+
+        events, mouse_pressed, mouse_pos, is_shift_pressed = event_source.get()
+        mouse_pressed_this_frame, mouse_released_this_frame = False, False
+
+        if not mouse_pressed:
+            pressed_button = None
+
+        for event in events:
+            if event.type == pg.QUIT:
+                app_running = False
+
+            elif event.type == pg.MOUSEBUTTONDOWN:
+                if event.button == 1:
+                    mouse_pressed_this_frame = True
+            elif event.type == pg.MOUSEBUTTONUP:
+                if event.button == 1:
+                    mouse_released_this_frame = True
+            elif event.type == pg.KEYDOWN:
+                if is_shift_pressed:
+                    if event.key in shift_key_to_button:
+                        shift_key_to_button[event.key].press()
+                else:
+                    if event.key in key_to_button:
+                        key_to_button[event.key].press()
+                    elif event.key == pg.K_DELETE:
+                        expression.delete_char(False)
+                    elif event.key == pg.K_COMMA:
+                        expression.add_char(',')
+                    elif event.key == pg.K_z:
+                        [b for b in buttons if b.name == 'undo'][0].press()
+                current_string += event.unicode
+                for name in expression.HIGHER_ORDER_FUNCTIONS:
+                    if current_string.endswith(name):
+                        expression.add_function(name)
+                        current_string = ''
+                for variable in expression.VARIABLES:
+                    if current_string.endswith(variable):
+                        expression.add_char(variable)
+                        current_string = ''
+                for name in name_to_button:
+                    if current_string.endswith(name):
+                        name_to_button[name].press()
+                        current_string = ''
+            elif event.type == pg.VIDEORESIZE:
+                WIDTH, HEIGHT = screen.get_size()
+                recreate_window = WIDTH < MIN_WIDTH or HEIGHT < MIN_HEIGHT
+                if WIDTH < MIN_WIDTH:
+                    WIDTH = MIN_WIDTH
+                if HEIGHT < MIN_HEIGHT:
+                    HEIGHT = MIN_HEIGHT
+                if recreate_window:
+                    screen = pg.display.set_mode((WIDTH, HEIGHT), pg.RESIZABLE)
+                NUMBER_BUTTON_SIZE = (
+                    (WIDTH - SPACE * 6) // 5,
+                    (HEIGHT - SPACE * 8) // 7)
+                BUTTON_SIZE = (
+                    (WIDTH - SPACE * 6) // 5,
+                    (NUMBER_BUTTON_SIZE[1] * 3 - SPACE) // 4)
+                create_buttons()
+
+        expression.draw()
+        for b in buttons:
+            b.update(mouse_pos, mouse_pressed,
+                     mouse_pressed_this_frame,
+                     mouse_released_this_frame)
+            b.draw()
+
+        pg.display.flip()
+finally:
+    checks_passed = event_source.close(expression)
+
+if not checks_passed:
+    sys.exit(1)